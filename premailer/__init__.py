@@ -1 +1 @@
-from premailer import Premailer, transform, __version__
+from .premailer import Premailer, transform, __version__
@@ -3,8 +3,23 @@ from lxml import etree
 from lxml.cssselect import CSSSelector
 import os
 import re
-import urllib
-import urlparse
+import sys
+try:
+    from urllib import urlopen
+    from urlparse import urljoin
+except ImportError:  # Python 3
+    from urllib.request import urlopen
+    from urllib.parse import urljoin
+
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = str
+
+try:
+    intern = sys.intern
+except AttributeError:  # Python 2
+    pass
 
 
 __version__ = '1.11'
@@ -16,6 +31,28 @@ class PremailerError(Exception):
 
 
 grouping_regex = re.compile('([:\-\w]*){([^}]+)}')
+# one 'key: value' declaration, without the surrounding whitespace. The
+# property name is kept as written, hacks like '*zoom' included.
+_declaration_regex = re.compile(
+    r'(?:^|;)\s*([^:;\s][^:;]*?)\s*:\s*([^;]+?)\s*(?=;|$)')
+
+# compiled CSSSelector objects keyed by selector string
+_SELECTOR_CACHE = {}
+_SELECTOR_CACHE_SIZE = 1024
+
+
+def _get_selector(selector):
+    """return a compiled CSSSelector for the selector string, compiling
+    it only the first time it's seen."""
+    sel = _SELECTOR_CACHE.get(selector)
+    if sel is None:
+        if len(_SELECTOR_CACHE) >= _SELECTOR_CACHE_SIZE:
+            _SELECTOR_CACHE.clear()
+        sel = _SELECTOR_CACHE[selector] = CSSSelector(selector)
+    return sel
+
+
+_SPACING_SIDES = ('-top:', '-right:', '-bottom:', '-left:')
 
 
 def _split_spacing_properties(rules):
@@ -36,14 +73,18 @@ def _split_spacing_properties(rules):
     """
     orules = []
     for selector, style in rules:
+        if 'margin' not in style and 'padding' not in style:
+            # nothing to split, which is the common case
+            orules.append((selector, style))
+            continue
 
-        properties = ""
+        parts = []
         for property_ in style.split(';'):
-            p, v = property_.split(':')
+            p, __, v = property_.partition(':')
             is_spacing = p in ('margin', 'padding')
 
             if not is_spacing:
-                properties += property_ + ';'
+                parts.extend((property_, ';'))
                 continue
 
             values = v.split()
@@ -64,23 +105,73 @@ def _split_spacing_properties(rules):
                 bottom = values[2]
                 left = values[3]
 
-            new_properties = ''
-            new_properties += p+'-top:%s;' % top
-            new_properties += p+'-right:%s;' % right
-            new_properties += p+'-bottom:%s;' % bottom
-            new_properties += p+'-left:%s;' % left
-
-            properties += new_properties
+            parts.extend((p, _SPACING_SIDES[0], top, ';',
+                          p, _SPACING_SIDES[1], right, ';',
+                          p, _SPACING_SIDES[2], bottom, ';',
+                          p, _SPACING_SIDES[3], left, ';'))
 
         # Remove trailing ';'
-        if properties[-1] == ';':
-            properties = properties[:-1]
+        properties = ''.join(parts).rstrip(';')
 
         orules.append((selector, properties))
 
     return orules
 
 
+def _parse_style(style):
+    """turn 'font-size:1px; color: red' into
+    {'font-size': '1px', 'color': 'red'}"""
+    # the same few property names come up over and over again so intern
+    # them (only byte strings can be interned on Python 2)
+    return dict((intern(k) if type(k) is str else k, v)
+                for k, v in _declaration_regex.findall(style))
+
+
+def _parse_groups(style):
+    """turn a style attribute, which might be grouped like
+    '{...} :hover{...}', into a dict of pseudoclass -> declarations.
+    Plain declarations end up under the '' key.
+    """
+    if '{' not in style:
+        # plain declarations, which is the common case
+        return {'': _parse_style(style)}
+    grouped_split = grouping_regex.findall(style)
+    if not grouped_split:
+        return {'': _parse_style(style)}
+    groups = {}
+    for class_, content in grouped_split:
+        groups[class_] = _parse_style(content)
+    return groups
+
+
+def _merge_into(groups, class_, decls):
+    """merge the declarations into groups[class_], the new declarations
+    replacing the old ones."""
+    old = groups.get(class_)
+    if old:
+        old.update(decls)
+    else:
+        groups[class_] = dict(decls)
+
+
+def _serialize_decls(decls):
+    return '; '.join(map(':'.join, decls.items()))
+
+
+def _serialize_groups(groups):
+    """the inverse of _parse_groups()"""
+    groups = dict((k, v) for (k, v) in groups.items() if v)
+    if not groups:
+        return ''
+    if list(groups) == ['']:
+        return _serialize_decls(groups[''])
+    all = []
+    for class_, mergeable in sorted(groups.items(),
+                                    key=lambda x: x[0].count(':')):
+        all.append('%s{%s}' % (class_, _serialize_decls(mergeable)))
+    return ' '.join(all)
+
+
 def _merge_styles(old, new, class_=''):
     """
     if ::
@@ -97,53 +188,50 @@ def _merge_styles(old, new, class_=''):
     Note: old could be something like '{...} ::first-letter{...}'
 
     """
-    news = {}
-    for k, v in [x.strip().split(':', 1) for x in new.split(';') if x.strip()]:
-        news[k.strip()] = v.strip()
-
-    groups = {}
-    grouped_split = grouping_regex.findall(old)
-    if grouped_split:
-        for old_class, old_content in grouped_split:
-            olds = {}
-            for k, v in [x.strip().split(':', 1) for
-                         x in old_content.split(';') if x.strip()]:
-                olds[k.strip()] = v.strip()
-            groups[old_class] = olds
-    else:
-        olds = {}
-        for k, v in [x.strip().split(':', 1) for
-                     x in old.split(';') if x.strip()]:
-            olds[k.strip()] = v.strip()
-        groups[''] = olds
-
-    # Perform the merge
-    merged = news
-    for k, v in groups.get(class_, {}).items():
-        if k not in merged:
-            merged[k] = v
-    groups[class_] = merged
-
-    if len(groups) == 1:
-        return '; '.join(['%s:%s' % (k, v) for
-                          (k, v) in groups.values()[0].items()])
-    else:
-        all = []
-        for class_, mergeable in sorted(groups.items(),
-                                        lambda x, y: cmp(x[0].count(':'),
-                                                         y[0].count(':'))):
-            all.append('%s{%s}' % (class_,
-                                   '; '.join(['%s:%s' % (k, v)
-                                              for (k, v)
-                                              in mergeable.items()])))
-        return ' '.join([x for x in all if x != '{}'])
+    groups = _parse_groups(old)
+    _merge_into(groups, class_, _parse_style(new))
+    return _serialize_groups(groups)
+
+
+def _iter_blocks(css_body):
+    """yield the (selectors, declarations) of every 'selectors {...}'
+    block in the (comment-free) css_body. The declarations end at the
+    first '}', so nested blocks aren't understood: for
+    '@media print{ div {...} } p {...}' the '@media print' block gets
+    'div {...' as its declarations and the outer '}' ends up in front
+    of the next block's selectors, as '} p'."""
+    i = 0
+    while True:
+        brace = css_body.find('{', i)
+        if brace == -1:
+            return
+        close = css_body.find('}', brace)
+        if close == -1:
+            return
+        yield css_body[i:brace], css_body[brace + 1:close]
+        i = close + 1
 
 
 _css_comments = re.compile(r'/\*.*?\*/', re.MULTILINE | re.DOTALL)
-_regex = re.compile('((.*?){(.*?)})', re.DOTALL | re.M)
-_semicolon_regex = re.compile(';(\s+)')
-_colon_regex = re.compile(':(\s+)')
-_importants = re.compile('\s*!important')
+# the element name a selector starts with, like 'table' in 'table td'
+_leading_tag_regex = re.compile(r'([a-zA-Z][\w-]*)(?![\w|-])')
+# whitespace after a ';' or ':'
+_separator_whitespace_regex = re.compile(r'([;:])\s+')
+_importants = re.compile(r'\s*!important')
+# compiled once, they're evaluated for every document
+_XPATH_STYLE = etree.XPath('//style')
+_XPATH_STYLE_ATTRIBUTE = etree.XPath('//@style')
+_XPATH_HREF_SRC = etree.XPath('//@href | //@src')
+_ABSOLUTE_URL_PREFIXES = ('http://', 'https://', 'mailto:', 'data:', 'ftp://')
+# styles that have an HTML attribute equivalent
+_STYLE_TO_ATTRIBUTE = (('text-align', 'align'),
+                       ('background-color', 'bgcolor'))
+_HTML_ATTRIBUTE_STYLES = frozenset(['text-align', 'background-color',
+                                    'width', 'height'])
+# rules of local external stylesheets, keyed by path, modification
+# time, size and the options that affect parsing
+_EXTERNAL_STYLES_CACHE = {}
+_EXTERNAL_STYLES_CACHE_SIZE = 64
 # These selectors don't apply to all elements. Rather, they specify
 # which elements to apply to.
 FILTER_PSEUDOSELECTORS = [':last-child', ':first-child', 'nth-child']
@@ -177,11 +265,12 @@ class Premailer(object):
         leftover = []
         rules = []
         css_body = _css_comments.sub('', css_body)
-        for each in _regex.findall(css_body.strip()):
-            __, selectors, bulk = each
+        css_body = _separator_whitespace_regex.sub(r'\1', css_body)
+        for selectors, bulk in _iter_blocks(css_body):
 
-            bulk = _semicolon_regex.sub(';', bulk.strip())
-            bulk = _colon_regex.sub(':', bulk.strip())
+            bulk = bulk.strip()
+            if self.strip_important:
+                bulk = _importants.sub('', bulk)
             if bulk.endswith(';'):
                 bulk = bulk[:-1]
             for selector in [x.strip() for
@@ -200,6 +289,36 @@ class Premailer(object):
 
         return rules, leftover
 
+    def _load_external_style(self, stylefile):
+        """return the rules of an external stylesheet. Local files are
+        only read and parsed again when they have been modified."""
+        if stylefile.startswith('http://'):
+            css_body = urlopen(stylefile).read()
+            if not isinstance(css_body, str):  # Python 3
+                css_body = css_body.decode('utf-8')
+            return self._parse_style_rules(css_body)[0]
+        if not os.path.exists(stylefile):
+            raise ValueError(u"Could not find external style: %s" %
+                             stylefile)
+
+        # the size too, for edits within the mtime resolution
+        stat = os.stat(stylefile)
+        key = (stylefile, stat.st_mtime, stat.st_size,
+               self.exclude_pseudoclasses, self.include_star_selectors,
+               self.strip_important)
+        rules = _EXTERNAL_STYLES_CACHE.get(key)
+        if rules is None:
+            f = codecs.open(stylefile)
+            try:
+                css_body = f.read()
+            finally:
+                f.close()
+            rules = tuple(self._parse_style_rules(css_body)[0])
+            if len(_EXTERNAL_STYLES_CACHE) >= _EXTERNAL_STYLES_CACHE_SIZE:
+                _EXTERNAL_STYLES_CACHE.clear()
+            _EXTERNAL_STYLES_CACHE[key] = rules
+        return rules
+
     def transform(self, pretty_print=True):
         """change the self.html and return it with CSS turned into style
         attributes.
@@ -207,16 +326,20 @@ class Premailer(object):
         if etree is None:
             return self.html
 
-        parser = etree.HTMLParser()
+        # premailer never looks elements up by id, so skip the id index
+        parser = etree.HTMLParser(collect_ids=False)
         stripped = self.html.strip()
         tree = etree.fromstring(stripped, parser).getroottree()
         page = tree.getroot()
         # lxml inserts a doctype if none exists, so only include it in
         # the root if it was in the original html.
-        root = tree if stripped.startswith(tree.docinfo.doctype) else page
+        doctype = tree.docinfo.doctype
+        if isinstance(stripped, bytes) and not isinstance(doctype, bytes):
+            # bytes input on Python 3
+            doctype = doctype.encode('ascii')
+        root = tree if stripped.startswith(doctype) else page
 
         if page is None:
-            print repr(self.html)
             raise PremailerError("Could not parse the html")
         assert page is not None
 
@@ -226,7 +349,7 @@ class Premailer(object):
 
         rules = []
 
-        for style in CSSSelector('style')(page):
+        for style in _XPATH_STYLE(page):
             these_rules, these_leftover = self._parse_style_rules(style.text)
             rules.extend(these_rules)
 
@@ -236,118 +359,124 @@ class Premailer(object):
                                         (k, v) in these_leftover])
             elif not self.keep_style_tags:
                 parent_of_style.remove(style)
+            elif self.strip_important:
+                style.text = _importants.sub('', style.text)
+
+        if self.strip_important:
+            for item in _XPATH_STYLE_ATTRIBUTE(page):
+                if '!important' in item:
+                    item.getparent().attrib['style'] = \
+                        _importants.sub('', item)
 
         if self.external_styles:
             for stylefile in self.external_styles:
-                if stylefile.startswith('http://'):
-                    css_body = urllib.urlopen(stylefile).read()
-                elif os.path.exists(stylefile):
-                    try:
-                        f = codecs.open(stylefile)
-                        css_body = f.read()
-                    finally:
-                        f.close()
-                else:
-                    raise ValueError(u"Could not find external style: %s" %
-                                     stylefile)
-                these_rules, these_leftover = self._parse_style_rules(css_body)
-                rules.extend(these_rules)
+                rules.extend(self._load_external_style(stylefile))
 
         rules = _split_spacing_properties(rules)
 
-        first_time = []
-        first_time_styles = []
+        # parse each rule's declarations once, up front
+        parsed_rules = []
         for selector, style in rules:
             new_selector = selector
             class_ = ''
             if ':' in selector:
-                new_selector, class_ = re.split(':', selector, 1)
-                class_ = ':%s' % class_
+                new_selector, __, class_ = selector.partition(':')
+                class_ = ':' + class_
             # Keep filter-type selectors untouched.
             if class_ in FILTER_PSEUDOSELECTORS:
                 class_ = ''
             else:
                 selector = new_selector
+            parsed_rules.append((selector, class_, _parse_style(style)))
 
-            sel = CSSSelector(selector)
-            for item in sel(page):
-                old_style = item.attrib.get('style', '')
-                if not item in first_time:
-                    if old_style:
-                        new_style = _merge_styles(style, old_style, class_)
-                    else:
-                        new_style = _merge_styles(old_style, style, class_)
-                    first_time.append(item)
-                    first_time_styles.append((item, old_style))
+        # the accumulated styles of each element, as a dict of
+        # pseudoclass -> declarations, only serialized at the very end
+        element_groups = {}
+        first_time_styles = []
+        # the same selector often appears in several rules (or several
+        # times once the pseudoclasses are taken off), so only run it
+        # against the document once
+        matches = {}
+        present_tags = set(item.tag for item in page.iter(etree.Element))
+        for selector, class_, decls in parsed_rules:
+            items = matches.get(selector)
+            if items is None:
+                leading_tag = _leading_tag_regex.match(selector)
+                if leading_tag and \
+                       leading_tag.group(1).lower() not in present_tags:
+                    # e.g. 'table td' when there's no <table>
+                    items = ()
                 else:
-                    new_style = _merge_styles(old_style, style, class_)
-                item.attrib['style'] = new_style
-                self._style_to_basic_html_attributes(item, new_style,
-                                                     force=True)
+                    items = _get_selector(selector)(page)
+                matches[selector] = items
+            for item in items:
+                groups = element_groups.get(item)
+                if groups is None:
+                    groups = element_groups[item] = {}
+                    old_style = item.attrib.get('style')
+                    if old_style:
+                        first_time_styles.append((item, old_style))
+                _merge_into(groups, class_, decls)
 
         # Re-apply initial inline styles.
         for item, inline_style in first_time_styles:
-            old_style = item.attrib.get('style', '')
-            if not inline_style:
-                continue
-            new_style = _merge_styles(old_style, inline_style, class_)
-            item.attrib['style'] = new_style
-            self._style_to_basic_html_attributes(item, new_style, force=True)
+            groups = element_groups[item]
+            for class_, decls in _parse_groups(inline_style).items():
+                _merge_into(groups, class_, decls)
+
+        for item, groups in element_groups.items():
+            new_style = _serialize_groups(groups)
+            if new_style:
+                # e.g. only 'p {}' matched, leave the element alone
+                item.attrib['style'] = new_style
+            self._style_to_basic_html_attributes(
+                item, groups.get('', {}), force=True)
 
         if self.remove_classes:
             # now we can delete all 'class' attributes
-            for item in page.xpath('//@class'):
-                parent = item.getparent()
-                del parent.attrib['class']
+            for item in page.iter(etree.Element):
+                item.attrib.pop('class', None)
 
         ##
         ## URLs
         ##
         if self.base_url:
-            for attr in ('href', 'src'):
-                for item in page.xpath("//@%s" % attr):
-                    parent = item.getparent()
-                    if attr == 'href' and self.preserve_internal_links \
-                           and parent.attrib[attr].startswith('#'):
-                        continue
-                    parent.attrib[attr] = urlparse.urljoin(self.base_url,
-                                                           parent.attrib[attr])
+            for item in _XPATH_HREF_SRC(page):
+                parent = item.getparent()
+                attr = item.attrname
+                url = parent.attrib[attr]
+                if url.startswith(_ABSOLUTE_URL_PREFIXES):
+                    # urljoin() would leave it as is anyway
+                    continue
+                if attr == 'href' and self.preserve_internal_links \
+                       and url.startswith('#'):
+                    continue
+                parent.attrib[attr] = urljoin(self.base_url, url)
 
         out = etree.tostring(root, method="html", pretty_print=pretty_print)
-        if self.strip_important:
-            out = _importants.sub('', out)
+        if not isinstance(out, str):  # Python 3
+            # non-ASCII characters come out as character references
+            out = out.decode('ascii')
         return out
 
-    def _style_to_basic_html_attributes(self, element, style_content,
-                                        force=False):
-        """given an element and styles like
-        'background-color:red; font-family:Arial' turn some of that into HTML
-        attributes. like 'bgcolor', etc.
-
-        Note, the style_content can contain pseudoclasses like:
-        '{color:red; border:1px solid green} :visited{border:1px solid green}'
+    def _style_to_basic_html_attributes(self, element, decls, force=False):
+        """given an element and parsed styles like
+        {'background-color': 'red', 'font-family': 'Arial'} turn some of
+        that into HTML attributes. like 'bgcolor', etc.
         """
-        if style_content.count('}') and \
-          style_content.count('{') == style_content.count('{'):
-            style_content = style_content.split('}')[0][1:]
+        if _HTML_ATTRIBUTE_STYLES.isdisjoint(decls):
+            return
 
         attributes = {}
-        for key, value in [x.split(':') for x in style_content.split(';')
-                           if len(x.split(':')) == 2]:
-            key = key.strip()
-
-            if key == 'text-align':
-                attributes['align'] = value.strip()
-            elif key == 'background-color':
-                attributes['bgcolor'] = value.strip()
-            elif key == 'width' or key == 'height':
-                value = value.strip()
+        for key, attribute in _STYLE_TO_ATTRIBUTE:
+            if key in decls:
+                attributes[attribute] = decls[key]
+        for key in ('width', 'height'):
+            if key in decls:
+                value = decls[key]
                 if value.endswith('px'):
                     value = value[:-2]
                 attributes[key] = value
-            #else:
-            #    print "key", repr(key)
-            #    print 'value', repr(value)
 
         for key, value in attributes.items():
             if key in element.attrib and not force:
@@ -356,8 +485,9 @@ class Premailer(object):
             element.attrib[key] = value
 
 
-def transform(html, base_url=None):
-    return Premailer(html, base_url=base_url).transform()
+def transform(html, base_url=None, pretty_print=False):
+    return Premailer(html, base_url=base_url).transform(
+        pretty_print=pretty_print)
 
 
 if __name__ == '__main__':
@@ -380,4 +510,4 @@ if __name__ == '__main__':
         </body>
         </html>"""
     p = Premailer(html)
-    print p.transform()
+    print(p.transform())
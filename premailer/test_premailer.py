@@ -1,7 +1,25 @@
 import re
 from nose.tools import eq_, ok_
 
-from premailer import Premailer, etree, _merge_styles
+from .premailer import Premailer, etree, transform, _merge_styles, \
+    _get_selector, _leading_tag_regex, _SELECTOR_CACHE
+
+
+def _sort_declarations(html):
+    """declarations come out in dict order, which differs between Python
+    versions, so sort them within each style attribute (and group)"""
+    def sort_decls(decls):
+        return '; '.join(sorted(x.strip() for x in decls.split(';')))
+
+    def sort_style(match):
+        style = match.group(1)
+        if '{' in style:
+            style = re.sub('{([^}]*)}',
+                           lambda m: '{%s}' % sort_decls(m.group(1)), style)
+        else:
+            style = sort_decls(style)
+        return 'style="%s"' % style
+    return re.sub('style="([^"]*)"', sort_style, html)
 
 
 def test_merge_styles_basic():
@@ -216,7 +234,7 @@ def test_style_block_with_external_urls():
     <head>
     <title>Title</title>
     </head>
-    <body style="color:#123; font-family:Omerta; background:url(http://example.com/bg.png)">
+    <body style="background:url(http://example.com/bg.png); color:#123; font-family:Omerta">
     <h1>Hi!</h1>
     </body>
     </html>'''
@@ -228,7 +246,7 @@ def test_style_block_with_external_urls():
 
     expect_html = whitespace_between_tags.sub('><', expect_html).strip()
     result_html = whitespace_between_tags.sub('><', result_html).strip()
-    assert expect_html == result_html
+    assert expect_html == _sort_declarations(result_html)
 
 
 def test_shortcut_function():
@@ -308,20 +326,20 @@ def test_css_with_pseudoclasses_included():
     '''
 
     p = Premailer(html)
-    result_html = p.transform()
+    result_html = _sort_declarations(p.transform())
 
     # because we're dealing with random dicts here we can't predict what
     # order the style attribute will be written in so we'll look for things
     # manually.
-    assert '<head></head>' in result_html
-    assert '<p style="::first-letter{font-size:300%; float:left}">'\
+    assert re.search('<head>\s*</head>', result_html), result_html
+    assert '<p style="::first-letter{float:left; font-size:300%}">'\
            'Paragraph</p>' in result_html
 
-    assert 'style="{color:red; border:1px solid green}' in result_html
+    assert 'style="{border:1px solid green; color:red}' in result_html
     assert ' :visited{border:1px solid green}' in result_html
     assert ' :hover{border:1px solid green; text-decoration:none}' in \
       result_html
-    print result_html
+    print(result_html)
     #assert 0
 
 
@@ -503,12 +521,12 @@ def test_strip_important():
     <head>
     </head>
     <body>
-    <p style="width:100%; height:100%" width="100%" height="100%">Paragraph</p>
+    <p style="height:100%; width:100%" width="100%" height="100%">Paragraph</p>
     </body>
     </html>"""
 
     p = Premailer(html, strip_important=True)
-    result_html = p.transform()
+    result_html = _sort_declarations(p.transform())
 
     whitespace_between_tags = re.compile('>\s*<',)
 
@@ -728,3 +746,270 @@ def test_doctype():
     result_html = whitespace_between_tags.sub('><', result_html).strip()
 
     eq_(expect_html, result_html)
+
+
+def test_selector_cache():
+    sel = _get_selector('p.footer')
+    ok_(sel is _get_selector('p.footer'))
+    ok_(sel is not _get_selector('p'))
+
+
+def test_selector_cache_is_bounded():
+    from .premailer import _SELECTOR_CACHE_SIZE
+    for i in range(_SELECTOR_CACHE_SIZE + 10):
+        _get_selector('p.class%d' % i)
+    ok_(len(_SELECTOR_CACHE) <= _SELECTOR_CACHE_SIZE)
+
+
+def test_inline_style_not_merged_into_pseudoclass():
+    """inline styles always belong to the plain group, even when the
+    last rule applied was a pseudoclass"""
+    html = """<html>
+    <head>
+    <style type="text/css">
+    a { color:red; }
+    a:hover { color:blue; }
+    </style>
+    </head>
+    <body>
+    <a href="#" style="font-weight:bold">Page</a>
+    </body>
+    </html>"""
+
+    p = Premailer(html)
+    result_html = p.transform()
+
+    ok_(' :hover{color:blue}' in result_html)
+    ok_('{color:red; font-weight:bold}' in result_html or
+        '{font-weight:bold; color:red}' in result_html)
+
+
+def test_repeated_selector_keeps_rule_order():
+    html = """<html>
+    <head>
+    <style type="text/css">
+    p { color:red; }
+    .special { color:blue; }
+    p { color:green; }
+    </style>
+    </head>
+    <body>
+    <p class="special">Text</p>
+    </body>
+    </html>"""
+
+    expect_html = """<html>
+    <head>
+    </head>
+    <body>
+    <p style="color:green">Text</p>
+    </body>
+    </html>"""
+
+    p = Premailer(html)
+    result_html = p.transform()
+
+    whitespace_between_tags = re.compile('>\s*<',)
+
+    expect_html = whitespace_between_tags.sub('><', expect_html).strip()
+    result_html = whitespace_between_tags.sub('><', result_html).strip()
+
+    eq_(expect_html, result_html)
+
+
+def test_external_styles_cached_until_modified():
+    import os
+    import tempfile
+    fd, stylefile = tempfile.mkstemp(suffix='.css')
+    try:
+        os.write(fd, b'h1 { color:red; }')
+        os.close(fd)
+        mtime = os.path.getmtime(stylefile)
+        html = '<html><body><h1>Hi!</h1></body></html>'
+
+        p = Premailer(html, external_styles=stylefile)
+        ok_('<h1 style="color:red">' in p.transform())
+        # cached result is used the second time
+        ok_('<h1 style="color:red">' in p.transform())
+
+        f = open(stylefile, 'w')
+        f.write('h1 { color:green; }')
+        f.close()
+        # an edit within the same (coarse) mtime is still picked up
+        os.utime(stylefile, (mtime, mtime))
+        ok_('<h1 style="color:green">' in p.transform())
+
+        f = open(stylefile, 'w')
+        f.write('h1 { color:olive; }')
+        f.close()
+        os.utime(stylefile, (mtime + 10, mtime + 10))
+        ok_('<h1 style="color:olive">' in p.transform())
+    finally:
+        os.remove(stylefile)
+
+
+def test_strip_important_leaves_text_alone():
+    html = """<html>
+    <head>
+    <style type="text/css">
+    p { color:red !important; }
+    </style>
+    </head>
+    <body>
+    <p style="font-weight:bold !important">This is  !important</p>
+    </body>
+    </html>"""
+
+    p = Premailer(html, strip_important=True)
+    result_html = p.transform()
+
+    ok_('!important</p>' in result_html)
+    ok_('!important;' not in result_html)
+    ok_('!important"' not in result_html)
+
+
+def test_strip_important_unmatched_inline_style():
+    html = """<html>
+    <head>
+    <style type="text/css">
+    p { color:red; }
+    </style>
+    </head>
+    <body>
+    <div style="color:blue !important">Text</div>
+    </body>
+    </html>"""
+
+    p = Premailer(html, strip_important=True)
+    result_html = p.transform()
+
+    ok_('<div style="color:blue">Text</div>' in result_html)
+
+
+def test_strip_important_kept_style_tag():
+    html = """<html>
+    <head>
+    <style type="text/css">p{color:red !important}</style>
+    </head>
+    <body>
+    <p>Text</p>
+    </body>
+    </html>"""
+
+    p = Premailer(html, strip_important=True, keep_style_tags=True)
+    result_html = p.transform()
+
+    ok_('<style type="text/css">p{color:red}</style>' in result_html)
+    ok_('!important' not in result_html)
+
+
+def test_shortcut_function_pretty_print():
+    html = ('<html><head><style>h1{color:#123}</style></head>'
+            '<body><div><h1>Hi!</h1></div></body></html>')
+
+    eq_(transform(html),
+        '<html><head></head>'
+        '<body><div><h1 style="color:#123">Hi!</h1></div></body></html>')
+    ok_('<head></head>\n' in transform(html, pretty_print=True))
+
+
+def test_whitespace_content_preserved():
+    html = ('<html><body><textarea>  </textarea>'
+            '<p>x<br> <br>y</p></body></html>')
+    eq_(transform(html), html)
+
+
+def test_skip_selectors_for_missing_elements():
+    html = """<html>
+    <head>
+    <style type="text/css">
+    table td { color:red; }
+    .special { font-weight:bold; }
+    * { margin-top:0; }
+    *|p { color:blue; }
+    </style>
+    </head>
+    <body>
+    <p class="special">Text</p>
+    </body>
+    </html>"""
+
+    _SELECTOR_CACHE.clear()
+    p = Premailer(html, include_star_selectors=True)
+    result_html = _sort_declarations(p.transform())
+
+    # there's no <table> so 'table td' is never even compiled
+    ok_('table td' not in _SELECTOR_CACHE)
+    ok_('.special' in _SELECTOR_CACHE)
+    ok_('*' in _SELECTOR_CACHE)
+    ok_('*|p' in _SELECTOR_CACHE)
+    ok_('<p style="color:blue; font-weight:bold; margin-top:0">Text</p>'
+        in result_html, result_html)
+    # a namespace prefix isn't taken for an element name
+    eq_(_leading_tag_regex.match('ns|p'), None)
+    eq_(_leading_tag_regex.match('table td').group(1), 'table')
+
+
+def test_empty_rules_add_no_style():
+    html = """<html>
+    <head>
+    <style type="text/css">
+    p {}
+    div { color }
+    </style>
+    </head>
+    <body>
+    <p>Text</p>
+    <div style="color:red">Text</div>
+    </body>
+    </html>"""
+
+    p = Premailer(html)
+    result_html = p.transform()
+
+    ok_('<p>Text</p>' in result_html, result_html)
+    ok_('<div style="color:red">Text</div>' in result_html, result_html)
+
+
+def test_property_hacks_kept():
+    from .premailer import _parse_style
+    eq_(_parse_style('*zoom:1; color:red; _height : 1px'),
+        {'*zoom': '1', 'color': 'red', '_height': '1px'})
+    eq_(_parse_style('background:url(http://example.com/bg.png); x'),
+        {'background': 'url(http://example.com/bg.png)'})
+
+    html = """<html>
+    <head>
+    <style type="text/css">
+    p { *zoom:1; }
+    </style>
+    </head>
+    <body>
+    <p>Text</p>
+    </body>
+    </html>"""
+
+    p = Premailer(html)
+    result_html = p.transform()
+
+    ok_('<p style="*zoom:1">Text</p>' in result_html, result_html)
+
+
+def test_bytes_input():
+    doctype = (b'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+               b'"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">')
+    body = (b'<html><head><meta http-equiv="Content-Type" '
+            b'content="text/html; charset=utf-8">'
+            b'<style>p{color:red}</style></head>'
+            b'<body><p>caf\xc3\xa9</p></body></html>')
+    expect = '<p style="color:red">caf&#233;</p>'
+
+    result_html = transform(doctype + b'\n' + body)
+    ok_(isinstance(result_html, str))
+    ok_(result_html.startswith('<!DOCTYPE html PUBLIC'), result_html)
+    ok_(expect in result_html, result_html)
+
+    # an encoding declaration is only allowed in byte strings
+    result_html = transform(
+        b'<?xml version="1.0" encoding="utf-8"?>\n' + body)
+    ok_(expect in result_html, result_html)
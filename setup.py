@@ -33,6 +33,9 @@ setup(name='premailer',
         "License :: OSI Approved :: Python Software Foundation License",
         "Operating System :: OS Independent",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
         "Topic :: Communications",
         "Topic :: Internet :: WWW/HTTP",
         "Topic :: Other/Nonlisted Topic",
@@ -44,7 +47,7 @@ setup(name='premailer',
       tests_require=['Nose'],
       zip_safe=True,
       install_requires=[
-        'lxml',
+        'lxml>=3.7',
       ],
       entry_points="""
       # -*- Entry points: -*-